@@ -1,5 +1,6 @@
+import numpy as np
 from psychopy import visual, core, logging
-from src.flicker_core import calculate_frequencies, calculate_cycle_params, generate_positions, generate_frame_pattern
+from src.flicker_core import calculate_frequencies, calculate_cycle_params, generate_positions, generate_frame_pattern, build_opacity_matrix, pack_frame_bits, run_flicker_loop
 
 # ==== Settings ====
 FULLSCREEN = True           # Should the window be opened in full screen mode (preferred, because of expected better performance)
@@ -8,6 +9,7 @@ DURATION_S = 5.0            # duration of experiment
 N_STIM = 9                  # number of flickering elements
 DUTY_CYCLE = 0.5            # represents ratio between ON and OFF stimuli presentation
 MIN_FRAMES_PER_CYCLE = 3     # Minimum number of frames that flicker should be in ON state. If MIN_FRAMES_PER_CYCLE is set to 3 and REFRESH_RATE is 60, max frequency of flickering will be 60Hz/3=20Hz.
+WARMUP_FRAMES = 30          # number of frames drawn before measurement starts, so that first-draw stalls (shader compilation, texture uploads) are not reported as dropped frames
 
 # ==== Logger ====
 logging.console.setLevel(logging.INFO)  # set PsychoPy logging handler console level to INFO, so that we get logging output with frames related messages
@@ -29,54 +31,58 @@ logging.info("Window open.")
 
 # ==== Calculate flickering frequencies ====
 freqs = calculate_frequencies(REFRESH_RATE, MIN_FRAMES_PER_CYCLE, N_STIM)
-logging.info(f"Chosen frequencies (Hz): {[round(f,3) for f in freqs]}")
+logging.info(f"Chosen frequencies (Hz): {np.round(freqs, 3).tolist()}")
 
 # ==== Calculate stimuli positions ====
 positions = generate_positions(N_STIM)
 
 # ==== Calculate frame cycles and create stimuli ====
-stimuli, cycles, labels = [], [], []
+stimuli = visual.ElementArrayStim(win, nElements=N_STIM, xys=positions, sizes=0.3,   # create all stimuli as one element array, so that they are drawn with a single draw call
+                                  elementTex=None, elementMask=None,   # no texture and no mask - plain white squares
+                                  colors=(1.0, 1.0, 1.0), colorSpace='rgb', opacities=0.0)
+frames_per_cycle, on_frames = calculate_cycle_params(REFRESH_RATE, freqs, DUTY_CYCLE)  # frame cycles of all stimuli at once
+labels = []
 for i, freq in enumerate(freqs):
-    frames_per_cycle, on_frames = calculate_cycle_params(REFRESH_RATE, freq, DUTY_CYCLE)
-    stim = visual.Rect(win, width=0.3, height=0.3, fillColor='white', pos=positions[i])  # create a stimuli
     label = visual.TextStim(win, text=f"{freq:.2f} Hz", pos=positions[i],  # create a label with flickering frequency
                             height=0.05, color='black')
-    stimuli.append(stim)
     labels.append(label)
-    cycles.append((frames_per_cycle, on_frames))
-    logging.info(f"Stim {i+1}: {freq:.2f} Hz → {frames_per_cycle} frames/cycle ({on_frames} ON, {frames_per_cycle - on_frames} OFF)")
+    logging.info(f"Stim {i+1}: {freq:.2f} Hz → {frames_per_cycle[i]} frames/cycle ({on_frames[i]} ON, {frames_per_cycle[i] - on_frames[i]} OFF)")
 
 
 # ==== Main flickering loop ====
 total_frames = int(REFRESH_RATE * DURATION_S)  # calculate number of total frames based on desired experiment duration
-frameN = 0
 # prepare frame patterns
 patterns = [
-    generate_frame_pattern(frames_per_cycle, on_frames, total_frames) for (frames_per_cycle, on_frames) in cycles
+    generate_frame_pattern(fpc, on, total_frames) for (fpc, on) in zip(frames_per_cycle, on_frames)
 ]
+opacity = build_opacity_matrix(patterns, total_frames)  # (total_frames, N_STIM) matrix of opacities, so that each frame only needs a row lookup
+frame_bits = pack_frame_bits(opacity)  # state of all stimuli packed into one uint64 word per frame, so that a change of state is a single integer comparison
+
+# ==== Warm-up ====
+warmup_opacity = np.repeat(opacity[:1], WARMUP_FRAMES, axis=0)  # hold the first frame static during warm-up
+run_flicker_loop(win, stimuli, labels, warmup_opacity, pack_frame_bits(warmup_opacity), hide_off_labels=True)
+
 logging.info(f"Starting flickering sequence (Estimated number of frames: {total_frames}).")
 win.recordFrameIntervals = True # start recording frame intervals so that we get report of dropped frames
 win.refreshThreshold = (1.0 / REFRESH_RATE) + 0.004 # set threshold for marking frame as dropped
+logging.console.setLevel(logging.WARNING) # silence INFO console output during flickering, so that printing does not compete with flip() for CPU
+core.rush(True) # raise process priority during flickering, so that the OS is less likely to preempt us before a flip
 
-for frameN in range(total_frames):
-    for (stim, label, pattern) in zip(stimuli, labels, patterns):
-        if pattern[frameN] == 1:
-            stim.opacity = 1.0
-            stim.draw()
-            label.draw()
-    win.flip()
-    
+run_flicker_loop(win, stimuli, labels, opacity, frame_bits, hide_off_labels=True)  # labels are only shown together with their ON stimulus
+core.rush(False) # restore normal priority
 win.recordFrameIntervals = False
+logging.console.setLevel(logging.INFO) # restore INFO console output for the report
 
 # ==== Report ====
 intervals = win.frameIntervals
 logging.info("===== Report =====")
 logging.info(f"Dropped frames: {win.nDroppedFrames}")
 if intervals:
-    mean_int = sum(intervals)/len(intervals)
-    sd_int = (sum((i - mean_int)**2 for i in intervals)/len(intervals))**0.5
-    stable_percent = 100 * (1 - win.nDroppedFrames / len(intervals))
-    logging.info(f"Total frames recorded: {len(intervals)}")
+    intervals = np.asarray(intervals, dtype=np.float64)
+    mean_int = intervals.mean()
+    sd_int = intervals.std()
+    stable_percent = 100 * (1 - win.nDroppedFrames / intervals.size)
+    logging.info(f"Total frames recorded: {intervals.size}")
     logging.info(f"Average frame interval: {mean_int*1000:.3f} ms (expected based on refresh rate {1000/REFRESH_RATE:.3f} ms)")
     logging.info(f"SD of frame intervals: {sd_int*1000:.3f} ms")
     logging.info(f"Stabilty percent: {stable_percent:.2f} %")
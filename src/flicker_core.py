@@ -1,7 +1,5 @@
 import math
 import numpy as np
-from scipy.signal import max_len_seq
-from psychopy import visual, core, logging
 
 
 def calculate_frequencies(refresh_rate: float, min_frames_per_cycle: int, n_stim: int):
@@ -11,14 +9,15 @@ def calculate_frequencies(refresh_rate: float, min_frames_per_cycle: int, n_stim
     assert n_stim > 0, f"n_stim must be bigger than zero. Provided value: {n_stim}"
     assert (refresh_rate - min_frames_per_cycle+1) >= n_stim, f"Too many stimuli provided for given refresh_rate and min_frames_per_cycle. Maximum number of allowed stimuli is {(refresh_rate - min_frames_per_cycle+1)}"
 
-    divisors = list(range(min_frames_per_cycle, int(refresh_rate) + 1))  # min_frames_per_cycle..refresh_rate
-    stable_freqs = [refresh_rate / d for d in divisors] # calculate possible frequencies based on REFRESH_RATE
+    divisors = np.arange(min_frames_per_cycle, int(refresh_rate) + 1, dtype=np.float64)  # min_frames_per_cycle..refresh_rate
+    stable_freqs = refresh_rate / divisors # calculate possible frequencies based on REFRESH_RATE
     return stable_freqs[:n_stim] # choose first N_STIM frequencies
 
-def calculate_cycle_params(refresh_rate: float, freq: float, duty_cycle: float):
-    frames_per_cycle = int(round(refresh_rate / freq))  # calculate number of frames for some frequency
-    on_frames = int(round(frames_per_cycle * duty_cycle)) # calculate number of "on" frames, based on DUTY_CYCLE
-    on_frames = max(1, min(on_frames, frames_per_cycle - 1)) # make sure that there is some flickering by ensuring we have at least 1 on frame and at least 1 off frame
+def calculate_cycle_params(refresh_rate: float, freq, duty_cycle: float):
+    # freq can be a single frequency or an array of frequencies (then arrays of frames_per_cycle and on_frames are returned)
+    frames_per_cycle = np.rint(refresh_rate / np.asarray(freq)).astype(int)  # calculate number of frames for some frequency
+    on_frames = np.rint(frames_per_cycle * duty_cycle).astype(int) # calculate number of "on" frames, based on DUTY_CYCLE
+    on_frames = np.maximum(1, np.minimum(on_frames, frames_per_cycle - 1)) # make sure that there is some flickering by ensuring we have at least 1 on frame and at least 1 off frame
     return frames_per_cycle, on_frames
 
 def generate_positions(n_stim: int):
@@ -27,34 +26,85 @@ def generate_positions(n_stim: int):
     spacing_x = 1.0 / (cols - 1) if cols > 1 else 0
     spacing_y = 1.0 / (rows - 1) if rows > 1 else 0
 
-    positions = []
-    for r in range(rows):
-        for c in range(cols):
-            if len(positions) == n_stim:
-                break
-            x = (c - (cols - 1)/2) * spacing_x
-            y = ((rows - 1)/2 - r) * spacing_y
-            positions.append((x, y))
-    return positions
+    xs = (np.arange(cols) - (cols - 1)/2) * spacing_x # x coordinates of columns, centered around 0
+    ys = ((rows - 1)/2 - np.arange(rows)) * spacing_y # y coordinates of rows, from top to bottom
+    grid_x, grid_y = np.meshgrid(xs, ys)
+    positions = np.stack([grid_x.ravel(), grid_y.ravel()], axis=1) # row-major grid positions, (rows*cols, 2)
+    return positions[:n_stim]
 
 def generate_frame_pattern(frames_per_cycle: int, on_frames: int, total_frames: int):
-    pattern = []
-    for frameN in range(total_frames):
-        cycle_pos = frameN % frames_per_cycle
-        pattern.append(1 if cycle_pos < on_frames else 0)
-    return pattern
+    cycle = np.zeros(frames_per_cycle, dtype=np.uint8) # one flicker cycle: first on_frames frames are ON, the rest are OFF
+    cycle[:on_frames] = 1
+    return np.resize(cycle, total_frames) # repeat the cycle directly into a total_frames long array (no over-allocation and slicing)
+
+def _max_len_seq(nbits: int, taps):
+    # generate maximum length sequence with a linear feedback shift register starting from all ones state (same output as scipy.signal.max_len_seq)
+    state = [1] * nbits
+    seq = np.empty((2**nbits) - 1, dtype=np.uint8)
+    idx = 0
+    for i in range(seq.size):
+        feedback = state[idx]
+        seq[i] = feedback
+        for tap in taps:
+            feedback ^= state[(tap + idx) % nbits]
+        state[idx] = feedback
+        idx = (idx + 1) % nbits
+    return seq
 
 def calculate_m_sequences(n_stim: int):
     nbits = 6 # Number of bits to use. Length of the resulting sequence will be (2**nbits) - 1. In case of 6, the lenght is 63.
+    taps = [5] # LFSR feedback taps for nbits=6 (the default taps of scipy.signal.max_len_seq)
     shift_step = 4 # Shift step of some stimuli. T(k) = 4xK ; k=0,1...n_stim
-    base_seq, state = max_len_seq(nbits=nbits)
+    base_seq = _max_len_seq(nbits, taps)
+    seq_len = base_seq.size
+
+    # generate shifted patterns for all stimuli at once: row s is base_seq rolled by s*shift_step (same as np.roll)
+    shifts = (np.arange(n_stim) * shift_step) % seq_len
+    idx = (np.arange(seq_len)[None, :] - shifts[:, None]) % seq_len
+    patterns = base_seq[idx].astype(np.uint8)
+
+    return patterns # (n_stim, seq_len) matrix, one pattern per row
+
+def build_opacity_matrix(patterns, total_frames: int):
+    # repeat each stimulus pattern up to total_frames and stack them as columns, so that row frameN holds opacities of all stimuli for that frame
+    return np.stack([np.resize(np.asarray(p, dtype=np.uint8), total_frames) for p in patterns], axis=1)
+
+def pack_frame_bits(opacity):
+    # pack each row of the (total_frames, n_stim) opacity matrix into a single uint64 word, where bit i holds the state of stimulus i
+    n_stim = opacity.shape[1]
+    assert n_stim <= 64, f"At most 64 stimuli can be packed into one frame word. Provided number of stimuli: {n_stim}"
+
+    packed = np.packbits(opacity, axis=1, bitorder='little') # (total_frames, ceil(n_stim/8)) bytes, bit i of a row is stimulus i
+    words = np.zeros((opacity.shape[0], 8), dtype=np.uint8)
+    words[:, :packed.shape[1]] = packed
+    return words.view('<u8').ravel().astype(np.uint64, copy=False) # 8 little endian bytes per frame -> one uint64 word
+
+def run_flicker_loop(win, stimuli, labels, opacity, frame_bits, hide_off_labels: bool = False):
+    # present all frames of the flickering sequence. The loop runs inside a function, so that every name used per frame is a fast local variable
+    # if hide_off_labels is True, label of a stimulus is only drawn in frames where that stimulus is ON
+    assert len(frame_bits) == len(opacity), f"frame_bits and opacity must have the same number of frames. Provided: {len(frame_bits)} and {len(opacity)}"
+    if len(opacity) == 0: # nothing to present (e.g. warm-up disabled or too short duration)
+        return
+
+    flip, draw_stimuli = win.flip, stimuli.draw  # bind methods used in the loop once, so that they are not looked up on every frame
+    all_label_draws = [label.draw for label in labels]
+    label_draws = [draw for draw, on in zip(all_label_draws, opacity[0]) if on] if hide_off_labels else all_label_draws
+    copyto = np.copyto
+    opacity_f32 = np.empty(opacity.shape[1], dtype=np.float32)  # scratch buffer reused for every opacity update, so that no new row array is allocated in the loop
 
-    patterns = []
-    # generate shifted patterns for all stimuli
-    for s in range(n_stim):
-        shift = s * shift_step
-        shifted_seq = np.roll(base_seq, shift)
-        logging.info(shifted_seq)
-        patterns.append(shifted_seq)
+    copyto(opacity_f32, opacity[0]) # start from the state of the first frame
+    stimuli.opacities = opacity_f32
+    frame_words = frame_bits.tolist() # plain Python ints compare faster than NumPy scalars
+    prev_bits = frame_words[0]
 
-    return patterns
+    for bits, row in zip(frame_words, opacity): # no frame counter - walk frame words and opacity rows together
+        if bits != prev_bits: # only update opacities when some stimulus changed state since previous frame
+            copyto(opacity_f32, row)
+            stimuli.opacities = opacity_f32
+            if hide_off_labels:
+                label_draws = [draw for draw, on in zip(all_label_draws, row) if on]
+            prev_bits = bits
+        draw_stimuli()
+        for draw_label in label_draws:
+            draw_label()
+        flip()
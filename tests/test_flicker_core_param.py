@@ -1,7 +1,7 @@
 import math
 import pytest
-import itertools
-from src.flicker_core import calculate_frequencies, calculate_cycle_params, generate_positions, generate_frame_pattern
+import numpy as np
+from src.flicker_core import calculate_frequencies, calculate_cycle_params, generate_positions, generate_frame_pattern, calculate_m_sequences, build_opacity_matrix, pack_frame_bits, run_flicker_loop
 
 # ==== Test frequency generation ====
 
@@ -77,6 +77,16 @@ def test_cycle_param_consistency(refresh_rate, freq, duty_cycle):
         f"Duty mismatch: expected {duty_cycle}, got {actual_duty:.2f}"
 
 
+@pytest.mark.parametrize("refresh_rate,min_frames_per_cycle,n_stim,duty_cycle", [(60, 3, 9, 0.5), (120, 1, 7, 0.25), (90, 5, 10, 0.75)])
+def test_cycle_params_vectorized(refresh_rate, min_frames_per_cycle, n_stim, duty_cycle):
+    """Passing an array of frequencies should give the same result as calling it per frequency."""
+    freqs = calculate_frequencies(refresh_rate, min_frames_per_cycle, n_stim)
+    frames_per_cycle, on_frames = calculate_cycle_params(refresh_rate, freqs, duty_cycle)
+
+    for i, freq in enumerate(freqs):
+        assert (frames_per_cycle[i], on_frames[i]) == calculate_cycle_params(refresh_rate, freq, duty_cycle)
+
+
 # ==== Test stable frequencies ====
 
 @pytest.mark.parametrize("refresh_rate, min_frames_per_cycle, n_stim", [(60, 3, 9), (90, 2, 15), (120, 10, 20)])
@@ -93,8 +103,9 @@ def generate_onoff_sequence(frames_per_cycle, on_frames, total_frames):
     Generate the expected binary ON/OFF pattern for a given flicker configuration.
     1 = ON, 0 = OFF
     """
-    pattern = [1]*on_frames + [0]*(frames_per_cycle - on_frames)
-    return list(itertools.islice(itertools.cycle(pattern), total_frames))   # cycle the pattern, take first total_frames elements from it and return them as list
+    base = np.zeros(frames_per_cycle, dtype=np.uint8)
+    base[:on_frames] = 1
+    return np.tile(base, -(-total_frames // frames_per_cycle))[:total_frames]   # repeat the cycle enough times and take first total_frames elements
 
 
 @pytest.mark.parametrize(
@@ -117,6 +128,162 @@ def test_flicker_onoff_sequence(refresh_rate, freq, duty_cycle, duration_s):
     expected = generate_onoff_sequence(frames_per_cycle, on_frames, total_frames)
     actual = generate_frame_pattern(frames_per_cycle, on_frames, total_frames)
 
-    assert expected == actual
+    assert np.array_equal(expected, np.asarray(actual))
+
+
+# ==== Test stimuli positions ====
+
+@pytest.mark.parametrize("n_stim", [1, 2, 5, 9, 10, 16])
+def test_positions_fill_grid_row_by_row(n_stim):
+    """Stimuli should be placed on a centered grid, filled row by row from top left."""
+    positions = generate_positions(n_stim)
+    cols = math.ceil(math.sqrt(n_stim))
+    rows = math.ceil(n_stim / cols)
+
+    assert positions.shape == (n_stim, 2)
+    for i, (x, y) in enumerate(positions):
+        r, c = divmod(i, cols)
+        assert x == pytest.approx((c - (cols - 1)/2) / (cols - 1) if cols > 1 else 0)
+        assert y == pytest.approx(((rows - 1)/2 - r) / (rows - 1) if rows > 1 else 0)
+
+
+# ==== Test m-sequences ====
+
+@pytest.mark.parametrize("n_stim", [1, 9, 20])
+def test_m_sequences_are_shifted_copies(n_stim):
+    """Pattern of stimulus k should be the base m-sequence shifted by 4*k frames."""
+    patterns = calculate_m_sequences(n_stim)
+    assert patterns.shape == (n_stim, 63)
+    assert patterns.dtype == np.uint8
+
+    for k in range(n_stim):
+        assert np.array_equal(patterns[k], np.roll(patterns[0], 4 * k))
+
+
+def test_m_sequence_is_maximum_length():
+    """Every non-zero 6 bit state should appear exactly once within one (cyclic) period of the base m-sequence."""
+    base_seq = calculate_m_sequences(1)[0]
+    windows = {tuple(np.roll(base_seq, -i)[:6]) for i in range(base_seq.size)}
+
+    assert base_seq.sum() == 32
+    assert len(windows) == 63
+    assert (0,) * 6 not in windows
+
+
+# ==== Test opacity matrix ====
+
+@pytest.mark.parametrize("total_frames", [1, 5, 12, 300])
+def test_opacity_matrix_repeats_patterns(total_frames):
+    """Each column of the opacity matrix should be its pattern repeated up to total_frames."""
+    patterns = [[1, 0], [1, 1, 0], [0, 1, 1, 0, 1]]
+    opacity = build_opacity_matrix(patterns, total_frames)
+
+    assert opacity.shape == (total_frames, len(patterns))
+    for i, pattern in enumerate(patterns):
+        for frameN in range(total_frames):
+            assert opacity[frameN, i] == pattern[frameN % len(pattern)]
+
+
+# ==== Test packed frame bits ====
+
+@pytest.mark.parametrize("n_stim", [1, 9, 64])
+def test_frame_bits_match_opacity_rows(n_stim):
+    """Bit i of the packed word of every frame should equal opacity of stimulus i in that frame."""
+    opacity = build_opacity_matrix(calculate_m_sequences(n_stim), 200)
+    frame_bits = pack_frame_bits(opacity)
+
+    assert frame_bits.shape == (200,)
+    for frameN in range(200):
+        word = int(frame_bits[frameN])
+        assert [(word >> i) & 1 for i in range(n_stim)] == opacity[frameN].tolist()
+
+
+def test_too_many_stimuli_for_frame_bits():
+    """Should raise AssertionError if there are more stimuli than bits in a frame word."""
+    with pytest.raises(AssertionError, match="At most 64 stimuli"):
+        pack_frame_bits(np.zeros((10, 65), dtype=np.uint8))
+
+
+# ==== Test flicker loop ====
+
+class FakeWindow:
+    def __init__(self, stimuli):
+        self.stimuli = stimuli
+        self.shown = []     # opacities of stimuli shown in every flipped frame
+
+    def flip(self):
+        self.shown.append(self.stimuli.opacities.copy())
+
+
+class FakeStimuli:
+    def __init__(self):
+        self.opacities = None
+        self.updates = 0
+        self.draws = 0
+
+    def __setattr__(self, name, value):
+        if name == "opacities" and value is not None:
+            self.updates += 1
+        super().__setattr__(name, value)
+
+    def draw(self):
+        self.draws += 1
+
+
+class FakeLabel:
+    def __init__(self):
+        self.draws = 0
+
+    def draw(self):
+        self.draws += 1
+
+
+@pytest.mark.parametrize("n_stim,total_frames", [(1, 10), (9, 300)])
+def test_flicker_loop_shows_every_frame(n_stim, total_frames):
+    """Every frame should be drawn and flipped with its row of the opacity matrix, opacities should only be set when the state changes."""
+    stimuli = FakeStimuli()
+    win = FakeWindow(stimuli)
+    labels = [FakeLabel() for _ in range(n_stim)]
+    opacity = build_opacity_matrix(calculate_m_sequences(n_stim), total_frames)
+    frame_bits = pack_frame_bits(opacity)
+
+    run_flicker_loop(win, stimuli, labels, opacity, frame_bits)
+
+    assert np.array_equal(np.array(win.shown), opacity)
+    assert stimuli.draws == total_frames
+    assert all(label.draws == total_frames for label in labels)
+    assert stimuli.updates == 1 + np.count_nonzero(frame_bits[1:] != frame_bits[:-1])
+
+
+def test_flicker_loop_hides_labels_of_off_stimuli():
+    """With hide_off_labels, every label should be drawn exactly in the frames where its stimulus is ON."""
+    n_stim, total_frames = 9, 300
+    stimuli = FakeStimuli()
+    win = FakeWindow(stimuli)
+    labels = [FakeLabel() for _ in range(n_stim)]
+    opacity = build_opacity_matrix(calculate_m_sequences(n_stim), total_frames)
+
+    run_flicker_loop(win, stimuli, labels, opacity, pack_frame_bits(opacity), hide_off_labels=True)
+
+    assert [label.draws for label in labels] == opacity.sum(axis=0).tolist()
+
+
+def test_flicker_loop_with_no_frames():
+    """An empty opacity matrix should present nothing instead of failing."""
+    stimuli = FakeStimuli()
+    win = FakeWindow(stimuli)
+    labels = [FakeLabel() for _ in range(9)]
+    opacity = np.zeros((0, 9), dtype=np.uint8)
+
+    run_flicker_loop(win, stimuli, labels, opacity, pack_frame_bits(opacity))
+
+    assert win.shown == []
+    assert stimuli.draws == 0
 
 
+def test_flicker_loop_frame_count_mismatch():
+    """Should raise AssertionError if frame_bits and opacity cover different number of frames."""
+    stimuli = FakeStimuli()
+    opacity = build_opacity_matrix(calculate_m_sequences(9), 100)
+    with pytest.raises(AssertionError, match="same number of frames"):
+        run_flicker_loop(FakeWindow(stimuli), stimuli, [], opacity, pack_frame_bits(opacity)[:50])